@@ -1,9 +1,13 @@
 import os
 import re
+import time
 import logging
 import datetime
 import json
 import asyncio
+import difflib
+import threading
+from collections import Counter
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes
 from telegram.ext import filters
@@ -22,15 +26,102 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Negative/inappropriate words - a frozen module-level constant so it is
+# built once at import and shared by every bot instance
+NEGATIVE_WORDS = frozenset({
+    'hate', 'stupid', 'idiot', 'moron', 'retard', 'shit', 'fuck', 'asshole',
+    'bastard', 'bitch', 'cunt', 'damn', 'hell', 'dumb', 'loser',
+    'fucking', 'ass', 'dick', 'piss', 'cock', 'pussy', 'fag', 'faggot',
+    'whore', 'slut', 'nigger', 'nigga', 'chink', 'spic', 'kike', 'terrorist'
+})
+
+def build_trie_pattern(words) -> str:
+    """Factor a word list into a shared-prefix regex alternation.
+
+    Words with common prefixes (fuck/fucking, fag/faggot) collapse into one
+    branch, so the engine scans each prefix once instead of retrying every
+    alternative from scratch.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}  # end-of-word marker
+
+    def node_pattern(node) -> str:
+        branches = [re.escape(char) + node_pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1:
+            pattern = branches[0]
+        else:
+            pattern = '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+    return node_pattern(trie)
+
+# The whole detector is derived from a compile-time constant word list, so
+# build it once at import: a trie-factored pattern for the scan and a
+# both-case initials set used as a cheap prefilter
+NEGATIVE_WORD_RE = re.compile(
+    r'\b' + build_trie_pattern(NEGATIVE_WORDS) + r'\b', re.IGNORECASE
+)
+NEGATIVE_INITIALS = (
+    frozenset(word[0] for word in NEGATIVE_WORDS)
+    | frozenset(word[0].upper() for word in NEGATIVE_WORDS)
+)
+
 class ContentModerationBot:
     def __init__(self, token: str):
         self.token = token
-        self.negative_words = self.load_negative_words()
         self.welcome_messages = {}
         
         # Google Docs and Sheets IDs
         self.knowledge_doc_id = "1uZ0g63V3Zxq8sIXrR3ggGQyArkNiOYseGsaX0hyCr6Y"
         self.learning_sheet_id = "1sq4zmYnvyWUymfWvv4sRDFdnj31mQKgkGEpQurHHgYk"
+
+        # In-process cache of the parsed knowledge doc so repeated queries
+        # don't refetch the document on every mention
+        self._kb_cache = None
+        self._kb_cache_ts = 0
+        self._kb_ttl = 300  # seconds
+        self._kb_index = {}
+        self._kb_lines_lower = []
+        self._kb_revision = None
+        self._kb_lock = asyncio.Lock()
+
+        # Memoized responses keyed by normalized query, valid for the
+        # lifetime of the current knowledge-doc revision
+        self._response_cache = {}
+
+        # Phrases already present in the learning sheet, hydrated once on the
+        # first save so dedupe is a set lookup instead of a full-sheet
+        # download; the lock keeps concurrent first saves from racing the
+        # hydration and clobbering each other's additions
+        self._seen_phrases = None
+        self._seen_lock = asyncio.Lock()
+
+        # Pending learning-sheet rows, flushed in batches by a background task
+        # so one append_rows call covers a burst of saves
+        self._save_queue = asyncio.Queue()
+        self._flush_task = None
+
+        # Mention pattern, compiled lazily once the bot username is known
+        self._mention_re = None
+        self._bot_username_lower = None
+
+        # Per-chat locks: replies within one chat stay ordered while
+        # different chats are handled concurrently
+        self._chat_locks = {}
+
+        # Local cache file so restarts don't re-download the learning sheet
+        # and knowledge doc from scratch
+        self._cache_path = os.environ.get('CACHE_FILE', 'bot_cache.json')
+        self._load_disk_cache()
         
         # Initialize Google services
         self.google_creds = None
@@ -70,8 +161,13 @@ class ContentModerationBot:
                 ]
             )
             
-            self.docs_service = build('docs', 'v1', credentials=self.google_creds)
-            self.sheets_service = build('sheets', 'v4', credentials=self.google_creds)
+            # static_discovery uses the discovery documents bundled with the
+            # client library, avoiding two multi-hundred-KB HTTPS fetches on
+            # every (re)start
+            self.docs_service = build('docs', 'v1', credentials=self.google_creds,
+                                      static_discovery=True)
+            self.sheets_service = build('sheets', 'v4', credentials=self.google_creds,
+                                        static_discovery=True)
             self.gc = gspread.authorize(self.google_creds)
             
             logger.info("Google services successfully initialized")
@@ -80,48 +176,171 @@ class ContentModerationBot:
             logger.error(f"Error initializing Google services: {e}")
             logger.warning("Continuing without Google services")
         
-    def load_negative_words(self) -> set:
-        """Load negative/inappropriate words"""
-        return {
-            'hate', 'stupid', 'idiot', 'moron', 'retard', 'shit', 'fuck', 'asshole',
-            'bastard', 'bitch', 'cunt', 'damn', 'hell', 'dumb', 'loser', 
-            'fucking', 'ass', 'dick', 'piss', 'cock', 'pussy', 'fag', 'faggot',
-            'whore', 'slut', 'nigger', 'nigga', 'chink', 'spic', 'kike', 'terrorist'
-        }
-    
+    def _is_mentioned(self, message) -> bool:
+        """Check for an @mention of the bot via Telegram's parsed entities"""
+        # Bots always have usernames, so a mention of the bot arrives as a
+        # 'mention' entity; no need to scan the text ourselves
+        for entity in message.entities or ():
+            if entity.type == 'mention':
+                if message.parse_entity(entity).lstrip('@').lower() == self._bot_username_lower:
+                    return True
+        return False
+
     def check_negative_content(self, text: str) -> bool:
         """Check if message contains negative/inappropriate words"""
-        text_lower = text.lower()
-        return any(re.search(r'\b' + re.escape(word) + r'\b', text_lower) for word in self.negative_words)
+        # Set disjointness over the raw characters is far cheaper than a
+        # regex pass and rejects most clean messages immediately
+        if NEGATIVE_INITIALS.isdisjoint(text):
+            return False
+        return NEGATIVE_WORD_RE.search(text) is not None
     
+    def _load_disk_cache(self):
+        """Restore the seen-phrase set and KB cache from the local cache file"""
+        try:
+            with open(self._cache_path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Could not read cache file {self._cache_path}: {e}")
+            return
+
+        if state.get('seen_phrases') is not None:
+            self._seen_phrases = set(state['seen_phrases'])
+        if state.get('kb_lines') is not None:
+            self._kb_cache = state['kb_lines']
+            self._kb_revision = state.get('kb_revision')
+            self._kb_lines_lower = [line.lower() for line in self._kb_cache]
+            self._kb_index = self._build_kb_index(self._kb_lines_lower)
+            # _kb_cache_ts stays 0 so the first query revalidates the
+            # revision id before trusting the restored parse
+
+        logger.info(f"Restored cache from {self._cache_path}")
+
+    def _save_disk_cache(self):
+        """Persist the seen-phrase set and KB cache across restarts"""
+        state = {
+            'seen_phrases': sorted(self._seen_phrases) if self._seen_phrases is not None else None,
+            'kb_lines': self._kb_cache,
+            'kb_revision': self._kb_revision,
+        }
+        # Write-then-rename keeps the file intact even if two threaded
+        # callers (KB refresh and the flush loop) save at the same time -
+        # os.replace is atomic, so readers only ever see a complete JSON
+        tmp_path = f"{self._cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self._cache_path)
+        except Exception as e:
+            logger.warning(f"Could not write cache file {self._cache_path}: {e}")
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def _load_kb_lines(self) -> list:
+        """Fetch the knowledge doc and return its text split into lines"""
+        # Only the paragraph text is used, so ask the API for just that
+        # instead of the full styled document model
+        doc = self.docs_service.documents().get(
+            documentId=self.knowledge_doc_id,
+            fields='revisionId,body/content(paragraph/elements/textRun/content)'
+        ).execute()
+        self._kb_revision = doc.get('revisionId')
+        content = doc.get('body', {}).get('content', [])
+
+        # Extract text from the document; collect pieces and join once rather
+        # than growing an immutable string O(n^2)-style
+        parts = []
+        for element in content:
+            if 'paragraph' in element:
+                for para_element in element['paragraph']['elements']:
+                    if 'textRun' in para_element:
+                        parts.append(para_element['textRun']['content'])
+
+        return ''.join(parts).split('\n')
+
+    def _build_kb_index(self, lines_lower: list) -> dict:
+        """Build an inverted index mapping each token to the lines containing it"""
+        index = {}
+        for i, line in enumerate(lines_lower):
+            for token in re.findall(r'\w+', line):
+                index.setdefault(token, set()).add(i)
+        return index
+
+    def _fetch_kb_revision(self) -> str:
+        """Fetch just the knowledge doc's current revision id"""
+        doc = self.docs_service.documents().get(
+            documentId=self.knowledge_doc_id, fields='revisionId'
+        ).execute()
+        return doc.get('revisionId')
+
+    def _get_kb_lines(self) -> list:
+        """Return the knowledge doc lines, refetching only when the TTL expires"""
+        if self._kb_cache is not None and time.monotonic() - self._kb_cache_ts < self._kb_ttl:
+            return self._kb_cache
+
+        # On TTL expiry, check the revision id first - a tiny response - and
+        # keep the cached parse if the document hasn't actually changed
+        if self._kb_cache is not None and self._fetch_kb_revision() == self._kb_revision:
+            self._kb_cache_ts = time.monotonic()
+            return self._kb_cache
+
+        # Lowercase each line exactly once per refresh; everything downstream
+        # (index build, fuzzy matching) reuses this list instead of re-lowering
+        self._kb_cache = self._load_kb_lines()
+        self._kb_lines_lower = [line.lower() for line in self._kb_cache]
+        self._kb_index = self._build_kb_index(self._kb_lines_lower)
+        self._kb_cache_ts = time.monotonic()
+        self._response_cache.clear()
+        self._save_disk_cache()
+        return self._kb_cache
+
     async def get_knowledge_response(self, query: str) -> str:
         """Search knowledge base in Google Docs for a response"""
         try:
             if not self.docs_service:
                 return "Knowledge base temporarily unavailable."
-                
-            # Retrieve the document content
-            doc = self.docs_service.documents().get(documentId=self.knowledge_doc_id).execute()
-            content = doc.get('body', {}).get('content', [])
-            
-            # Extract text from the document
-            full_text = ""
-            for element in content:
-                if 'paragraph' in element:
-                    for para_element in element['paragraph']['elements']:
-                        if 'textRun' in para_element:
-                            full_text += para_element['textRun']['content']
-            
-            # Simple keyword matching
-            query_lower = query.lower()
-            lines = full_text.split('\n')
-            
-            for line in lines:
-                line_lower = line.lower()
-                if any(word in line_lower for word in query_lower.split()):
-                    return line.strip()
-            
-            return "I don't have information about that yet. I'll save it to learn more."
+
+            # Run the (possibly network-bound) fetch in a thread so a slow
+            # Docs round-trip doesn't stall the event loop; the lock keeps
+            # concurrent queries from stampeding the refresh when the TTL
+            # expires (cache hits hold it only momentarily)
+            async with self._kb_lock:
+                lines = await asyncio.to_thread(self._get_kb_lines)
+
+            # Identical questions come up constantly in group chats - serve
+            # repeats straight from the memoized responses
+            query_norm = ' '.join(query.lower().split())
+            cached = self._response_cache.get(query_norm)
+            if cached is not None:
+                return cached
+
+            # Score candidate lines via the inverted index - only lines sharing
+            # at least one token with the query are considered
+            scores = Counter()
+            for token in re.findall(r'\w+', query_norm):
+                for i in self._kb_index.get(token, ()):
+                    scores[i] += 1
+
+            if scores:
+                best_line, _ = scores.most_common(1)[0]
+                response = lines[best_line].strip()
+            else:
+                # No exact token overlap - fall back to fuzzy matching over
+                # the cached lowercase lines to catch near-miss spellings.
+                # This only runs on index misses, and repeats are memoized.
+                close = difflib.get_close_matches(query_norm, self._kb_lines_lower, n=1, cutoff=0.6)
+                if close:
+                    response = lines[self._kb_lines_lower.index(close[0])].strip()
+                else:
+                    response = "I don't have information about that yet. I'll save it to learn more."
+
+            if len(self._response_cache) >= 1024:
+                self._response_cache.clear()
+            self._response_cache[query_norm] = response
+            return response
         
         except HttpError as e:
             logger.error(f"Google Docs API error: {e}")
@@ -130,27 +349,77 @@ class ContentModerationBot:
             logger.error(f"Error accessing knowledge base: {e}")
             return "Sorry, I'm having trouble accessing my knowledge base right now."
     
+    def _load_seen_phrases(self) -> set:
+        """Download the first column of the learning sheet as a lowercase set"""
+        # Only column A holds the phrases - no need to transfer the context
+        # and timestamp columns just to build the dedupe set
+        sheet = self.gc.open_by_key(self.learning_sheet_id).sheet1
+        return {value.lower() for value in sheet.col_values(1) if value}
+
+    def _append_learning_rows(self, rows: list):
+        """Append a batch of rows to the learning sheet"""
+        sheet = self.gc.open_by_key(self.learning_sheet_id).sheet1
+        sheet.append_rows(rows, value_input_option='RAW')
+
     async def save_to_learning_sheet(self, phrase: str, context: str = ""):
-        """Save unfamiliar phrases to Google Sheets for later learning"""
+        """Queue unfamiliar phrases for the learning sheet"""
         try:
             if not self.gc:
                 logger.warning("Google Sheets not available - skipping save")
                 return
-                
-            sheet = self.gc.open_by_key(self.learning_sheet_id).sheet1
-            
-            # Get current data to avoid duplicates
-            existing_data = sheet.get_all_values()
-            existing_phrases = [row[0].lower() for row in existing_data if row]
-            
-            if phrase.lower() not in existing_phrases:
-                sheet.append_row([phrase, context, str(datetime.datetime.now())])
-                logger.info(f"Saved new phrase to learning sheet: {phrase}")
-            else:
+
+            # Hydrate the dedupe set once; afterwards saves cost a set lookup.
+            # Re-check under the lock - with concurrent updates two chats can
+            # hit the first save together, and a second assignment would wipe
+            # out phrases added after the first one landed
+            if self._seen_phrases is None:
+                async with self._seen_lock:
+                    if self._seen_phrases is None:
+                        self._seen_phrases = await asyncio.to_thread(self._load_seen_phrases)
+
+            if phrase.lower() in self._seen_phrases:
                 logger.info(f"Phrase already exists in learning sheet: {phrase}")
-            
+                return
+
+            self._seen_phrases.add(phrase.lower())
+            timestamp = datetime.datetime.now(datetime.UTC).isoformat(timespec='seconds')
+            self._save_queue.put_nowait([phrase, context, timestamp])
+
         except Exception as e:
             logger.error(f"Error saving to learning sheet: {e}")
+
+    async def _flush_saves_loop(self):
+        """Drain queued learning-sheet rows and append them in batches"""
+        while True:
+            rows = [await self._save_queue.get()]
+
+            try:
+                # Brief window for more rows to accumulate so a burst of saves
+                # costs one API call instead of one per phrase
+                await asyncio.sleep(2)
+                while len(rows) < 50:
+                    try:
+                        rows.append(self._save_queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+
+                try:
+                    await asyncio.to_thread(self._append_learning_rows, rows)
+                    await asyncio.to_thread(self._save_disk_cache)
+                    logger.info(f"Flushed {len(rows)} phrases to learning sheet")
+                except Exception as e:
+                    # Put the batch back for the next cycle - the phrases are
+                    # already marked seen, so dropping them here would lose
+                    # them for good
+                    for row in rows:
+                        self._save_queue.put_nowait(row)
+                    logger.error(f"Error flushing learning sheet: {e}")
+            except asyncio.CancelledError:
+                # Cancellation lands at one of the awaits above; put the
+                # in-flight batch back so the shutdown drain can flush it
+                for row in rows:
+                    self._save_queue.put_nowait(row)
+                raise
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle incoming messages"""
@@ -162,7 +431,15 @@ class ContentModerationBot:
             # Ignore messages from the bot itself
             if message.from_user.id == context.bot.id:
                 return
-            
+
+            # The username is fixed for the process lifetime, so compile the
+            # mention-stripping pattern once instead of per message
+            if self._mention_re is None and context.bot.username:
+                self._bot_username_lower = context.bot.username.lower()
+                self._mention_re = re.compile(
+                    r'@' + re.escape(context.bot.username) + r'\s*', re.IGNORECASE
+                )
+
             # Check for negative content
             if self.check_negative_content(message.text):
                 # Flag the message
@@ -176,17 +453,33 @@ class ContentModerationBot:
                 logger.info(f"Flagged and deleted message from {message.from_user.id}: {message.text}")
             
             # Otherwise, try to respond using knowledge base if the bot is mentioned
-            elif context.bot.username and (context.bot.username.lower() in message.text.lower() or message.chat.type == 'private'):
+            # Telegram already parsed mentions server-side, so check the
+            # entity list instead of lowercasing and scanning the text;
+            # messages without mention entities cost O(#entities) here
+            elif self._mention_re and (message.chat.type == 'private' or self._is_mentioned(message)):
                 # Extract the query (remove bot mention if present)
-                query = re.sub(r'@' + context.bot.username + r'\s*', '', message.text, flags=re.IGNORECASE).strip()
+                query = self._mention_re.sub('', message.text).strip()
                 
                 if query:
-                    response = await self.get_knowledge_response(query)
-                    await message.reply_text(response)
-                    
-                    # If no response found, save for learning
-                    if "I don't have information" in response:
-                        await self.save_to_learning_sheet(query, f"User: {message.from_user.id}, Chat: {message.chat.id}")
+                    # With concurrent_updates enabled, updates from the same
+                    # chat can be in flight together; serialize the
+                    # lookup+reply per chat so answers arrive in the order
+                    # asked while other chats proceed in parallel
+                    if message.chat.id not in self._chat_locks and len(self._chat_locks) >= 512:
+                        # Bound the table: drop locks for idle chats
+                        self._chat_locks = {
+                            chat_id: chat_lock
+                            for chat_id, chat_lock in self._chat_locks.items()
+                            if chat_lock.locked()
+                        }
+                    lock = self._chat_locks.setdefault(message.chat.id, asyncio.Lock())
+                    async with lock:
+                        response = await self.get_knowledge_response(query)
+                        await message.reply_text(response)
+
+                        # If no response found, save for learning
+                        if "I don't have information" in response:
+                            await self.save_to_learning_sheet(query, f"User: {message.from_user.id}, Chat: {message.chat.id}")
                         
         except Exception as e:
             logger.error(f"Error handling message: {e}")
@@ -233,49 +526,97 @@ class ContentModerationBot:
         except Exception as e:
             logger.error(f"Error in help command: {e}")
     
-    async def run(self):
-        """Start the bot with polling"""
-        try:
+    async def _post_init(self, application):
+        """Start background tasks once the application is initialized"""
+        # Start the learning-sheet batch flusher
+        if self.gc:
+            self._flush_task = asyncio.create_task(self._flush_saves_loop())
+
+    async def _post_shutdown(self, application):
+        """Stop background tasks when the application shuts down"""
+        if self._flush_task:
+            # Wait for the task to actually finish so its cancellation
+            # handler has re-queued any in-flight batch before we drain
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        # Flush whatever is still sitting in the accumulation window - those
+        # phrases are already marked seen and would otherwise be lost on
+        # every graceful shutdown
+        rows = []
+        while True:
+            try:
+                rows.append(self._save_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        if rows:
+            try:
+                await asyncio.to_thread(self._append_learning_rows, rows)
+                logger.info(f"Flushed {len(rows)} phrases to learning sheet on shutdown")
+            except Exception as e:
+                logger.error(f"Error flushing learning sheet on shutdown: {e}")
+
+    def run(self):
+        """Start the bot with polling, restarting with backoff on failure"""
+        backoff = 10
+        while True:
             # Create application
-            application = Application.builder().token(self.token).build()
-            
+            application = (
+                Application.builder()
+                .token(self.token)
+                # Process updates concurrently so a slow Google round-trip in
+                # one chat doesn't stall every other chat; ordering within a
+                # chat is restored by the per-chat locks in handle_message
+                .concurrent_updates(True)
+                .post_init(self._post_init)
+                .post_shutdown(self._post_shutdown)
+                .build()
+            )
+
             # Register handlers
             application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
             application.add_handler(CommandHandler("start", self.start_command))
             application.add_handler(CommandHandler("help", self.help_command))
             application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, self.welcome_new_member))
-            
+
             logger.info("Bot application setup completed successfully")
             logger.info("Starting bot polling...")
-            
-            # Start polling with proper error handling
-            await application.initialize()
-            await application.start()
-            await application.updater.start_polling()
-            
-            # Keep the bot running
-            await asyncio.Event().wait()
-            
-        except Exception as e:
-            logger.error(f"Error running bot: {e}")
-            # Try to restart after a delay
-            await asyncio.sleep(10)
+
+            started = time.monotonic()
+            try:
+                # run_polling drives initialize/start/idle/shutdown itself
+                # and handles SIGINT/SIGTERM gracefully; when it returns the
+                # bot was asked to stop, so don't restart
+                application.run_polling(close_loop=False)
+                return
+            except Exception as e:
+                logger.error(f"Error running bot: {e}")
+
+            # A run that survived for a while started up cleanly, so begin
+            # the backoff ladder over instead of ratcheting toward the cap
+            if time.monotonic() - started > 60:
+                backoff = 10
+
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 300)
             logger.info("Restarting bot...")
-            await self.run()
 
 # Main execution
-async def main():
+def main():
     # Get bot token from environment variable
     BOT_TOKEN = os.environ.get('BOT_TOKEN')
-    
+
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN environment variable is required")
         return
-    
+
     # Create and run bot
     bot = ContentModerationBot(BOT_TOKEN)
-    await bot.run()
+    bot.run()
 
 if __name__ == '__main__':
-    # Run the async main function
-    asyncio.run(main())
+    main()